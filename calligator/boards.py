@@ -2,8 +2,13 @@ import cv2
 from cv2 import aruco
 import numpy as np
 from abc import ABC, abstractmethod
-from tqdm import trange
-from collections import defaultdict
+from tqdm import tqdm
+import threading
+import queue
+import sys
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 
 def get_video_params_cap(cap):
@@ -22,9 +27,190 @@ def get_video_params(fname):
     return params
 
 
+class _DetectionWindow:
+    """Tracks which frames of a video detect_video should run detection on:
+    every skip-th frame, plus the int(skip / 2) frames at the start and after each detection.
+    The consumer reports back each frame it is done with, so the reader knows which frames it can skip."""
+
+    def __init__(self, skip):
+        self.skip = skip
+        self.half = int(skip / 2)
+        self.limit = self.half
+        self.resolved = -1
+        self.running = True
+        self._lock = threading.Lock()
+
+    def needed(self, framenum):
+        """Whether framenum must be checked, given the frames resolved so far.
+        Once True, this stays True."""
+        return framenum % self.skip == 0 or framenum < self.limit
+
+    def maybe_needed(self, framenum, last_sent):
+        """Whether framenum could still turn out to be needed,
+        once the frames up to last_sent are resolved."""
+        with self._lock:
+            if self.needed(framenum):
+                return True
+            return last_sent > self.resolved and \
+                framenum < last_sent + self.half
+
+    def resolve(self, framenum, detected=False):
+        """Marks framenum as done, extending the window if the board was detected in it."""
+        with self._lock:
+            if detected:
+                self.limit = max(self.limit, framenum + self.half)
+            self.resolved = framenum
+
+
+def _frame_producer(cap, window, q):
+    """Reads frames from cap into q as (framenum, frame) tuples, followed by None.
+    Frames that window rules out are put as (framenum, None), and only grabbed, without being decoded.
+    Stops early once window.running is cleared."""
+    length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    last_sent = -1
+    for framenum in range(length):
+        if not window.running or not cap.grab():
+            break
+        if not window.maybe_needed(framenum, last_sent):
+            q.put((framenum, None))
+            continue
+        ret, frame = cap.retrieve()
+        if not ret:
+            break
+        last_sent = framenum
+        q.put((framenum, frame))
+    q.put(None)
+
+
+def _iter_video_frames(cap, window, prefetch=8):
+    """Yields (framenum, frame) for every frame of cap, with frame None where window ruled it out.
+    Frames are decoded in a background thread, up to prefetch frames ahead of the caller."""
+    q = queue.Queue(maxsize=prefetch)
+
+    reader = threading.Thread(target=_frame_producer,
+                              args=(cap, window, q), daemon=True)
+    reader.start()
+
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            yield item
+    finally:
+        # unblock the reader if we stopped before it reached the end
+        window.running = False
+        while reader.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _iter_images(fnames, prefetch=8, n_threads=4):
+    """Yields (index, image) for each image filename.
+    Up to prefetch images are read and decoded ahead of the caller by a pool of n_threads threads."""
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque()
+        for framenum, fname in enumerate(fnames):
+            pending.append((framenum, executor.submit(cv2.imread, fname)))
+            if len(pending) >= prefetch:
+                num, future = pending.popleft()
+                yield num, future.result()
+        while pending:
+            num, future = pending.popleft()
+            yield num, future.result()
+
+
+_worker_board = None
+
+
+def _init_detect_worker(board):
+    global _worker_board
+    _worker_board = board
+
+
+def _detect_one(args, board=None):
+    """Takes a (framenum, frame) pair, where frame is either an image or an image filename.
+    Returns (framenum, corners, ids) as detected by board, or by the board of this worker process."""
+    framenum, frame = args
+    if board is None:
+        board = _worker_board
+    if isinstance(frame, str):
+        frame = cv2.imread(frame)
+    corners, ids = board.detect_image(frame)
+    return framenum, corners, ids
+
+
+def _make_detect_pool(board, n_jobs):
+    # forkserver avoids copying the parent and re-importing cv2 for every worker
+    if sys.platform.startswith('linux'):
+        ctx = mp.get_context('forkserver')
+    else:
+        ctx = mp.get_context()
+    return ctx.Pool(n_jobs, initializer=_init_detect_worker,
+                    initargs=(board,))
+
+
+def _scatter_points(out, corners, ids):
+    """Writes each corner into out at the row given by its id, all in one indexed store."""
+    ids_flat = np.asarray(ids).ravel().astype(np.intp, copy=False)
+    corners_arr = np.asarray(corners).reshape(-1, 1, 2)
+    if ids_flat.shape[0] != corners_arr.shape[0]:
+        raise ValueError(
+            'got {} corners but {} ids'.format(corners_arr.shape[0],
+                                               ids_flat.shape[0]))
+    out[ids_flat] = corners_arr
+    return out
+
+
+def _as_contiguous(arr, dtype):
+    """Returns arr as a C-contiguous array of the given dtype, only copying if it is not one already."""
+    if arr.dtype != dtype or not arr.flags.c_contiguous:
+        arr = np.ascontiguousarray(arr, dtype=dtype)
+    return arr
+
+
+def _as_cv_points(points, ndim=2):
+    """Returns points as a C-contiguous float32 array of shape (N, 1, ndim), as opencv expects.
+    Only copies if points is not in that layout already."""
+    return _as_contiguous(np.reshape(points, (-1, 1, ndim)), np.float32)
+
+
+def _as_flat_detection(corners, ids):
+    """Returns corners as a C-contiguous float32 (N, 2) array and ids as a C-contiguous int32 (N,) array.
+    These are views of the given arrays unless a conversion is needed. None is passed through."""
+    if corners is not None:
+        corners = _as_contiguous(np.reshape(corners, (-1, 2)), np.float32)
+    if ids is not None:
+        ids = _as_contiguous(np.ravel(ids), np.int32)
+    return corners, ids
+
+
+class _CachedIntrinsics:
+    """Wraps a camera so its matrix and distortions are only fetched once, as contiguous float64 arrays.
+    Any other attribute is looked up on the camera itself."""
+
+    def __init__(self, camera):
+        self._camera = camera
+        self._K = np.ascontiguousarray(camera.get_camera_matrix(),
+                                       dtype='float64')
+        self._D = np.ascontiguousarray(camera.get_distortions(),
+                                       dtype='float64')
+
+    def get_camera_matrix(self):
+        return self._K
+
+    def get_distortions(self):
+        return self._D
+
+    def __getattr__(self, name):
+        return getattr(self._camera, name)
+
+
 def fix_rvec(rvec, tvec):
     # https://github.com/opencv/opencv/issues/8813
-    T = tvec.ravel()[0]
+    T = tvec.ravel()
     R = cv2.Rodrigues(rvec)[0]
 
     # Unrelated -- makes Y the up axis, Z forward
@@ -53,6 +239,79 @@ def fix_rvec(rvec, tvec):
     return cv2.Rodrigues(R)[0]
 
 
+def _rodrigues_batch(rvecs):
+    """Converts (N, 3) rotation vectors into (N, 3, 3) rotation matrices."""
+    theta = np.linalg.norm(rvecs, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        k = np.nan_to_num(rvecs / theta[:, None])
+    K = np.zeros((len(rvecs), 3, 3))
+    K[:, 0, 1] = -k[:, 2]
+    K[:, 0, 2] = k[:, 1]
+    K[:, 1, 0] = k[:, 2]
+    K[:, 1, 2] = -k[:, 0]
+    K[:, 2, 0] = -k[:, 1]
+    K[:, 2, 1] = k[:, 0]
+    sin = np.sin(theta)[:, None, None]
+    cos = np.cos(theta)[:, None, None]
+    return np.eye(3) + sin * K + (1 - cos) * np.einsum('nij,njk->nik', K, K)
+
+
+def _rodrigues_inv_batch(R):
+    """Converts (N, 3, 3) rotation matrices into (N, 3) rotation vectors."""
+    cos = np.clip((np.trace(R, axis1=1, axis2=2) - 1) / 2, -1, 1)
+    theta = np.arccos(cos)
+    vee = np.stack([R[:, 2, 1] - R[:, 1, 2],
+                    R[:, 0, 2] - R[:, 2, 0],
+                    R[:, 1, 0] - R[:, 0, 1]], axis=1)
+    sin = np.sin(theta)
+
+    # theta / sin(theta) goes to 1 for small angles
+    scale = np.ones(len(R))
+    normal = sin > 1e-5
+    scale[normal] = theta[normal] / sin[normal]
+    rvecs = vee * scale[:, None] / 2
+
+    # near 180 degrees the skew part vanishes, let opencv work out the axis
+    for i in np.where(~normal & (cos < 0))[0]:
+        rvecs[i] = cv2.Rodrigues(R[i])[0].ravel()
+
+    return rvecs
+
+
+def fix_rvec_batch(rvecs, tvecs):
+    """Same as fix_rvec, but takes (N, 3) rvecs and tvecs and returns the (N, 3) fixed rvecs."""
+    rvecs = np.asarray(rvecs, dtype='float64').reshape(-1, 3)
+    tvecs = np.asarray(tvecs, dtype='float64').reshape(-1, 3)
+
+    if len(rvecs) < 8:
+        # not worth the setup, use the opencv version
+        out = [fix_rvec(r, t) for r, t in zip(rvecs, tvecs)]
+        return np.array(out, dtype='float64').reshape(-1, 3)
+
+    R = _rodrigues_batch(rvecs) @ np.array([
+        [1, 0, 0],
+        [0, 0, 1],
+        [0, -1, 0],
+    ])
+
+    flipped = (0 < R[:, 1, 1]) & (R[:, 1, 1] < 1)
+    if np.any(flipped):
+        Rf = R[flipped] * np.array([
+            [1, -1, 1],
+            [1, -1, 1],
+            [-1, 1, -1],
+        ])
+        forward = np.array([0, 0, 1])
+        T = tvecs[flipped]
+        tnorm = T / np.linalg.norm(T, axis=1)[:, None]
+        axis = np.cross(tnorm, forward)
+        angle = -2 * np.arccos(tnorm @ forward)
+        R[flipped] = np.einsum('nij,njk->nik',
+                               _rodrigues_batch(angle[:, None] * axis), Rf)
+
+    return _rodrigues_inv_batch(R)
+
+
 def merge_rows(all_rows, cam_names=None):
     """Takes a list of rows returned from detect_images or detect_videos.
     Returns a merged version of the rows, wherein rows from different videos/images with same framenum are grouped.
@@ -65,24 +324,13 @@ def merge_rows(all_rows, cam_names=None):
     if cam_names is None:
         cam_names = range(len(all_rows))
 
-    rows_dict = defaultdict(dict)
-    framenums = set()
+    merged_dict = dict()
 
     for cname, rows in zip(cam_names, all_rows):
         for r in rows:
-            num = r['framenum']
-            rows_dict[cname][num] = r
-            framenums.add(num)
+            merged_dict.setdefault(r['framenum'], dict())[cname] = r
 
-    framenums = sorted(framenums)
-    merged = []
-
-    for num in framenums:
-        d = dict()
-        for cname in cam_names:
-            if num in rows_dict[cname]:
-                d[cname] = rows_dict[cname][num]
-        merged.append(d)
+    merged = [merged_dict[num] for num in sorted(merged_dict)]
 
     return merged
 
@@ -100,15 +348,15 @@ def extract_points(merged,
     """
 
     if cam_names is None:
-        s = set.union(*[set(r.keys()) for r in merged])
-        cam_names = sorted(s)
+        cam_names = sorted(dict.fromkeys(k for r in merged for k in r))
 
     test = board.get_empty_detection().reshape(-1, 2)
     n_cams = len(cam_names)
     n_points_per_detect = test.shape[0]
     n_detects = len(merged)
 
-    objp_template = board.get_object_points().reshape(-1, 3)
+    objp_template = np.asarray(board.get_object_points(),
+                               dtype='float64').reshape(-1, 3)
 
 
     imgp = np.full((n_cams, n_detects, n_points_per_detect, 2),
@@ -120,45 +368,58 @@ def extract_points(merged,
     tvecs = np.full((n_cams, n_detects, n_points_per_detect, 3),
                     np.nan, dtype='float64')
 
-    objp = np.empty((n_detects, n_points_per_detect, 3),
-                    dtype='float64')
-
-    board_ids = np.empty((n_detects, n_points_per_detect),
-                         dtype='int32')
+    # gather every detection first, then scatter them all at once
+    cixs = []
+    rixs = []
+    all_filled = []
+    all_rvecs = []
+    all_tvecs = []
 
     for rix, row in enumerate(merged):
-        objp[rix] = np.copy(objp_template)
-        board_ids[rix] = rix
-
         for cix, cname in enumerate(cam_names):
             if cname in row:
-                filled = row[cname]['filled'].reshape(-1, 2)
-                bad = np.any(np.isnan(filled), axis=1)
-                num_good = np.sum(~bad)
-                if num_good < min_points or \
-                   (row[cname].get('rvec', None) is None or \
-                    row[cname].get('tvec', None) is None):
+                r = row[cname]
+                if r.get('rvec', None) is None or r.get('tvec', None) is None:
                     continue
-
-                imgp[cix, rix] = filled
-
-                rvecs[cix, rix, ~bad] = row[cname]['rvec'].ravel()
-                tvecs[cix, rix, ~bad] = row[cname]['tvec'].ravel()
+                cixs.append(cix)
+                rixs.append(rix)
+                all_filled.append(r['filled'].reshape(-1, 2))
+                all_rvecs.append(r['rvec'].ravel())
+                all_tvecs.append(r['tvec'].ravel())
+
+    if len(cixs) > 0:
+        filled = np.array(all_filled, dtype='float64')
+        bad = np.any(np.isnan(filled), axis=2)
+        num_good = np.sum(~bad, axis=1)
+        keep = num_good >= min_points
+
+        cixs = np.array(cixs)[keep]
+        rixs = np.array(rixs)[keep]
+        bad = bad[keep, :, None]
+
+        imgp[cixs, rixs] = filled[keep]
+        rvecs[cixs, rixs] = np.where(
+            bad, np.nan, np.array(all_rvecs, dtype='float64')[keep, None])
+        tvecs[cixs, rixs] = np.where(
+            bad, np.nan, np.array(all_tvecs, dtype='float64')[keep, None])
 
     imgp = np.reshape(imgp, (n_cams, -1, 2))
     rvecs = np.reshape(rvecs, (n_cams, -1, 3))
     tvecs = np.reshape(tvecs, (n_cams, -1, 3))
-    objp = np.reshape(objp, (-1, 3))
-    board_ids = np.reshape(board_ids, (-1))
 
-    num_good = np.sum(~np.isnan(imgp), axis=0)[:, 0]
-    good = num_good >= min_cameras
+    # only the x coordinate is needed to tell which points are present
+    present = ~np.isnan(imgp[:, :, 0])
+    cam_counts = present.sum(axis=0, dtype='int32')
+    good = cam_counts >= min_cameras
 
     imgp = imgp[:, good]
     rvecs = rvecs[:, good]
     tvecs = tvecs[:, good]
-    objp = objp[good]
-    board_ids = board_ids[good]
+
+    # every row shares the board template, so only look it up for the points kept
+    good_ix = np.flatnonzero(good)
+    objp = objp_template[good_ix % n_points_per_detect]
+    board_ids = np.int32(good_ix // n_points_per_detect)
 
     extra = {
         'objp': objp,
@@ -186,14 +447,17 @@ def extract_rtvecs(merged,
     """
 
     if cam_names is None:
-        s = set.union(*[set(r.keys()) for r in merged])
-        cam_names = sorted(s)
+        cam_names = sorted(dict.fromkeys(k for r in merged for k in r))
 
     n_cams = len(cam_names)
     n_detects = len(merged)
 
-    rtvecs = np.empty((n_cams, n_detects, 6), dtype='float64')
-    rtvecs[:] = np.nan
+    rtvecs = np.full((n_cams, n_detects, 6), np.nan, dtype='float64')
+
+    cixs = []
+    rixs = []
+    all_rvecs = []
+    all_tvecs = []
 
     for rix, row in enumerate(merged):
         for cix, cname in enumerate(cam_names):
@@ -216,19 +480,25 @@ def extract_rtvecs(merged,
                 if r['rvec'] is None or r['tvec'] is None:
                     continue
 
-                rvec = r['rvec'].ravel()
-                tvec = r['tvec'].ravel()
+                cixs.append(cix)
+                rixs.append(rix)
+                all_rvecs.append(r['rvec'].ravel())
+                all_tvecs.append(r['tvec'].ravel())
 
-                rtvec = np.hstack([rvec, tvec])
-                rtvecs[cix, rix] = rtvec
+    if len(cixs) > 0:
+        rtvecs[cixs, rixs, :3] = all_rvecs
+        rtvecs[cixs, rixs, 3:] = all_tvecs
 
-    num_good = np.sum(~np.isnan(rtvecs), axis=0)[:, 0]
+    num_good = np.sum(~np.isnan(rtvecs[:, :, 0]), axis=0, dtype='int32')
     rtvecs = rtvecs[:, num_good >= min_cameras]
 
     return rtvecs
 
 
 class CalibrationObject(ABC):
+    # convert and resize HD frames with OpenCL when opencv has a device for it
+    USE_OCL = False
+
     @abstractmethod
     def draw(self, size):
         pass
@@ -253,24 +523,135 @@ class CalibrationObject(ABC):
     def get_empty_detection(self):
         pass
 
+    def __getstate__(self):
+        # keep class level overrides of the settings too, as worker processes
+        # import the class afresh
+        state = dict(self.__dict__)
+        for name in dir(type(self)):
+            if name.isupper():
+                state.setdefault(name, getattr(self, name))
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # pickling doesn't keep the shared template read-only
+        empty = self.__dict__.get('empty_detection')
+        if isinstance(empty, np.ndarray):
+            empty.flags.writeable = False
+
+    def _use_ocl(self, image):
+        return self.USE_OCL and image.shape[0] >= 720 and cv2.ocl.useOpenCL()
+
+    def _to_gray(self, image):
+        if len(image.shape) != 3:
+            return image
+        if self._use_ocl(image):
+            return cv2.cvtColor(cv2.UMat(image), cv2.COLOR_BGR2GRAY).get()
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
     def estimate_pose_image(self, camera, image):
         corners, ids = self.detect_image(image)
         return self.estimate_pose_points(camera, corners, ids)
 
-    def detect_images(self, images, progress=False, prefix=None):
+    def _detect_frames(self, frames, n_jobs=1, chunksize=1):
+        """Runs detect_image over an iterable of (framenum, frame) pairs, frame being an image or a filename.
+        Yields (framenum, corners, ids) tuples.
+        If n_jobs is not 1, detection is spread over a pool of n_jobs processes (all cores if None)
+        and results come back in arbitrary order."""
+        if n_jobs == 1:
+            for args in frames:
+                yield _detect_one(args, self)
+            return
+
+        with _make_detect_pool(self, n_jobs) as pool:
+            yield from pool.imap_unordered(_detect_one, frames,
+                                           chunksize=chunksize)
+
+    def _detect_video_frames(self, frames, window, n_jobs=1):
+        """Runs detect_image over the (framenum, frame) pairs from _iter_video_frames,
+        on the frames that window says are needed, reporting each one back to it.
+        Yields (framenum, corners, ids) for every frame in order, with corners None for frames not checked.
+        If n_jobs is not 1, detection is spread over a pool of n_jobs processes (all cores if None).
+        Frames that might be needed are then detected ahead of time while workers are free,
+        and their results dropped if the window does not reach them."""
+        if n_jobs == 1:
+            for framenum, frame in frames:
+                corners, ids = None, None
+                if frame is not None and window.needed(framenum):
+                    _, corners, ids = _detect_one((framenum, frame), self)
+                window.resolve(framenum, corners is not None
+                               and len(corners) > 0)
+                yield framenum, corners, ids
+            return
+
+        n_workers = n_jobs or mp.cpu_count()
+        # (framenum, result) in frame order, result None for frames not sent to the pool
+        pending = deque()
+        in_flight = 0
+        last_sent = -1
+
+        def resolve_oldest():
+            nonlocal in_flight
+            framenum, result = pending.popleft()
+            corners, ids = None, None
+            if result is not None:
+                in_flight -= 1
+                _, corners, ids = result.get()
+                if not window.needed(framenum):
+                    corners, ids = None, None
+            window.resolve(framenum, corners is not None and len(corners) > 0)
+            return framenum, corners, ids
+
+        with _make_detect_pool(self, n_jobs) as pool:
+            for framenum, frame in frames:
+                while True:
+                    if frame is None:
+                        send = False
+                    elif window.needed(framenum):
+                        send = True
+                    elif in_flight == 0 or \
+                         framenum >= last_sent + window.half:
+                        # nothing still pending can reach this frame
+                        send = False
+                    elif in_flight < n_workers:
+                        send = True
+                    else:
+                        yield resolve_oldest()
+                        continue
+                    break
+
+                if send:
+                    pending.append((framenum, pool.apply_async(
+                        _detect_one, ((framenum, frame), ))))
+                    in_flight += 1
+                    last_sent = framenum
+                else:
+                    pending.append((framenum, None))
+
+                while pending and (pending[0][1] is None
+                                   or pending[0][1].ready()):
+                    yield resolve_oldest()
+
+            while pending:
+                yield resolve_oldest()
+
+    def detect_images(self, images, progress=False, prefix=None, n_jobs=1):
+        """Detects the board in each of the image filenames given.
+        Set n_jobs to run detection over several processes (all cores if None)."""
         length = len(images)
         rows = []
 
-        if progress:
-            it = trange(length, ncols=70)
+        if n_jobs == 1:
+            frames = _iter_images(images)
         else:
-            it = range(length)
+            # workers read the images themselves, so only filenames are sent over
+            frames = enumerate(images)
 
-        for framenum in it:
-            imname = images[framenum]
-            frame = cv2.imread(imname)
+        it = self._detect_frames(frames, n_jobs, chunksize=16)
+        if progress:
+            it = tqdm(it, total=length, ncols=70)
 
-            corners, ids = self.detect_image(frame)
+        for framenum, corners, ids in it:
             if corners is not None:
                 if prefix is None:
                     key = framenum
@@ -281,45 +662,39 @@ class CalibrationObject(ABC):
                     'framenum': key,
                     'corners': corners,
                     'ids': ids,
-                    'fname': imname
+                    'fname': images[framenum]
                 }
                 rows.append(row)
 
+        rows.sort(key=lambda r: r['framenum'])
         rows = self.fill_points_rows(rows)
 
         return rows
 
-    def detect_video(self, vidname, prefix=None, skip=20, progress=False):
+    def detect_video(self, vidname, prefix=None, skip=20, progress=False,
+                     n_jobs=1):
+        """Detects the board in every skip-th frame of the video,
+        and in the int(skip / 2) frames following each detection.
+        Set n_jobs to run detection over several processes (all cores if None)."""
         cap = cv2.VideoCapture(vidname)
         length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         rows = []
 
-        go = int(skip / 2)
-
+        window = _DetectionWindow(skip)
+        it = self._detect_video_frames(_iter_video_frames(cap, window),
+                                       window, n_jobs)
         if progress:
-            it = trange(length, ncols=70)
-        else:
-            it = range(length)
+            it = tqdm(it, total=length, ncols=70)
 
-        for framenum in it:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            if framenum % skip != 0 and go <= 0:
-                continue
-
-            corners, ids = self.detect_image(frame)
+        for framenum, corners, ids in it:
             if corners is not None and len(corners) > 0:
                 if prefix is None:
                     key = framenum
                 else:
                     key = (prefix, framenum)
-                go = int(skip / 2)
                 row = {'framenum': key, 'corners': corners, 'ids': ids}
                 rows.append(row)
 
-            go = max(0, go - 1)
-
         cap.release()
 
         rows = self.fill_points_rows(rows)
@@ -327,6 +702,8 @@ class CalibrationObject(ABC):
         return rows
 
     def estimate_pose_rows(self, camera, rows):
+        # the intrinsics are the same for every row, so only fetch them once
+        camera = _CachedIntrinsics(camera)
         for row in rows:
             rvec, tvec = self.estimate_pose_points(camera,
                                                    row['corners'],
@@ -337,7 +714,8 @@ class CalibrationObject(ABC):
 
     def fill_points_rows(self, rows):
         for row in rows:
-            row['filled'] = self.fill_points(row['corners'], row['ids'])
+            corners, ids = _as_flat_detection(row['corners'], row['ids'])
+            row['filled'] = self.fill_points(corners, ids)
         return rows
 
     def get_all_calibration_points(self, rows):
@@ -346,22 +724,20 @@ class CalibrationObject(ABC):
         objpoints = self.get_object_points()
         objpoints = objpoints.reshape(-1, 3)
 
-        all_obj = []
-        all_img = []
-
-        for row in rows:
-            filled_test = row['filled'].reshape(-1, 2)
-            good = np.all(~np.isnan(filled_test), axis=1)
-            filled_app = row['filled'].reshape(-1, 2)
-            objp = np.copy(objpoints)
-            all_obj.append(objp[good])
-            all_img.append(filled_app[good])
+        # size the output first, so the points can be written straight into it
+        goods = [np.all(~np.isnan(row['filled'].reshape(-1, 2)), axis=1)
+                 for row in rows]
+        counts = [np.count_nonzero(good) for good in goods]
+        total = sum(counts)
 
-        all_obj = np.vstack(all_obj)
-        all_img = np.vstack(all_img)
+        all_obj = np.empty((total, 3), dtype='float64')
+        all_img = np.empty((total, 2), dtype='float64')
 
-        all_obj = np.array(all_obj, dtype='float64')
-        all_img = np.array(all_img, dtype='float64')
+        off = 0
+        for row, good, k in zip(rows, goods, counts):
+            all_obj[off:off + k] = objpoints[good]
+            all_img[off:off + k] = row['filled'].reshape(-1, 2)[good]
+            off += k
 
         return all_obj, all_img
 
@@ -372,9 +748,12 @@ class Checkerboard(CalibrationObject):
         cv2.CALIB_CB_ADAPTIVE_THRESH + \
         cv2.CALIB_CB_FAST_CHECK
 
+    # corners rarely move any more after 10 iterations
     SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS +
                        cv2.TERM_CRITERIA_MAX_ITER,
-                       30, 0.01)
+                       10, 0.01)
+
+    SUBPIX_WINSIZE = (3, 3)
 
     def __init__(self, squaresX, squaresY, square_length=1):
         self.squaresX = squaresX
@@ -387,10 +766,13 @@ class Checkerboard(CalibrationObject):
         objp[:, :2] = np.mgrid[0:squaresX, 0:squaresY].T.reshape(-1, 2)
         objp *= square_length
         self.objPoints = objp
+        self._objPoints_cv = _as_cv_points(objp, ndim=3)
 
         self.ids = np.arange(total_size)
 
-        self.empty_detection = np.zeros((total_size, 1, 2)) * np.nan
+        # shared template, fill_points and get_empty_detection copy it before writing
+        self.empty_detection = np.full((total_size, 1, 2), np.nan, np.float32)
+        self.empty_detection.flags.writeable = False
 
     def get_size(self):
         size = (self.squaresX, self.squaresY)
@@ -410,30 +792,23 @@ class Checkerboard(CalibrationObject):
         return np.copy(self.empty_detection)
 
     def fill_points(self, corners, ids=None):
-        out = self.get_empty_detection()
         if corners is None or len(corners) == 0:
-            return out
+            return self.empty_detection
         if ids is None:
             return corners
         else:
-            ids = ids.ravel()
-            for i, cxs in zip(ids, corners):
-                out[i] = cxs
-            return out
+            return _scatter_points(self.get_empty_detection(), corners, ids)
 
     def detect_image(self, image, subpix=True):
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image
+        gray = self._to_gray(image)
 
         size = self.get_size()
         ret, corners = cv2.findChessboardCorners(gray, size,
                                                  self.DETECT_PARAMS)
 
         if ret and subpix:
-            corners = cv2.cornerSubPix(gray, corners, (3, 3), (-1, -1),
-                                       self.SUBPIX_CRITERIA)
+            corners = cv2.cornerSubPix(gray, corners, self.SUBPIX_WINSIZE,
+                                       (-1, -1), self.SUBPIX_CRITERIA)
 
         if corners is None:
             ids = None
@@ -446,20 +821,26 @@ class Checkerboard(CalibrationObject):
         return self.objPoints
 
     def estimate_pose_points(self, camera, points, ids=None):
-        ngood = np.sum(~np.isnan(points)) // 2
-        if points is None or ngood < 4:
+        if points is None:
             return None, None
 
-        n_points = points.size // 2
-        points = np.reshape(points, (n_points, 1, 2))
+        points = _as_cv_points(points)
 
         K = camera.get_camera_matrix()
         D = camera.get_distortions()
-        obj_points = self.get_object_points()
+        obj_points = self._objPoints_cv
 
         if points.shape[0] != obj_points.shape[0]:
             return None, None
 
+        # filled detections mark missing corners with nan, leave those out
+        good = ~np.any(np.isnan(points[:, 0]), axis=1)
+        if np.sum(good) < 4:
+            return None, None
+        if not np.all(good):
+            obj_points = obj_points[good]
+            points = points[good]
+
         retval, rvec, tvec, inliers = cv2.solvePnPRansac(obj_points,
                                                          points,
                                                          K,
@@ -470,6 +851,9 @@ class Checkerboard(CalibrationObject):
         return rvec, tvec
 
 
+# opencv >= 4.7 replaced the aruco free functions with detector classes
+HAS_ARUCO_DETECTOR = hasattr(aruco, 'ArucoDetector')
+
 ARUCO_DICTS = {
     (4, 50): aruco.DICT_4X4_50,
     (5, 50): aruco.DICT_5X5_50,
@@ -491,6 +875,20 @@ ARUCO_DICTS = {
 
 
 class CharucoBoard(CalibrationObject):
+    # set below 1 to first search for markers on a frame downscaled by this
+    # factor, the charuco corners are still refined on the full resolution frame
+    DETECT_SCALE = 1
+
+    # markers whose bit cells are smaller than this many pixels on the downscaled
+    # frame may be missed there, so if any found marker is that small (or none
+    # are found at all), search the full resolution frame instead
+    DETECT_SCALE_MIN_CELL_PX = 3
+
+    # fewer markers than this can't give enough charuco corners to be used
+    # later on (pose estimation and extract_points need at least 4), so
+    # interpolation is skipped for them
+    MIN_MARKERS_FOR_INTERP = 3
+
     def __init__(self,
                  squaresX,
                  squaresY,
@@ -498,18 +896,18 @@ class CharucoBoard(CalibrationObject):
                  marker_length,
                  marker_bits=4,
                  dict_size=50,
-                 aruco_dict=None):
+                 aruco_dict=None,
+                 legacy_pattern=False):
         self.squaresX = squaresX
         self.squaresY = squaresY
         self.square_length = square_length
         self.marker_length = marker_length
+        self.marker_bits = marker_bits
+        self.dict_size = dict_size
+        # set for boards drawn with the pre 4.6 layout, only opencv >= 4.6 tells the two apart
+        self.legacy_pattern = legacy_pattern
 
-        dkey = (marker_bits, dict_size)
-        self.dictionary = aruco.getPredefinedDictionary(ARUCO_DICTS[dkey])
-
-        self.board = aruco.CharucoBoard_create(squaresX, squaresY,
-                                               square_length, marker_length,
-                                               self.dictionary)
+        self._build_detectors()
 
         total_size = (squaresX - 1) * (squaresY - 1)
 
@@ -519,9 +917,72 @@ class CharucoBoard(CalibrationObject):
         objp *= square_length
         self.objPoints = objp
 
-        self.empty_detection = np.zeros((total_size, 1, 2)) * np.nan
+        # shared template, fill_points and get_empty_detection copy it before writing
+        self.empty_detection = np.full((total_size, 1, 2), np.nan, np.float32)
+        self.empty_detection.flags.writeable = False
         self.total_size = total_size
 
+    def __getstate__(self):
+        # the opencv objects can't be pickled, they are rebuilt from the rest on unpickling
+        state = super().__getstate__()
+        return {k: v for k, v in state.items()
+                if not type(v).__module__.startswith('cv2')}
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._build_detectors()
+
+    def _build_detectors(self):
+        dkey = (self.marker_bits, self.dict_size)
+        self.dictionary = aruco.getPredefinedDictionary(ARUCO_DICTS[dkey])
+
+        size = (self.squaresX, self.squaresY)
+        if HAS_ARUCO_DETECTOR:
+            self.board = aruco.CharucoBoard(size, self.square_length,
+                                            self.marker_length,
+                                            self.dictionary)
+            if self.legacy_pattern:
+                self.board.setLegacyPattern(True)
+        else:
+            self.board = aruco.CharucoBoard_create(*size, self.square_length,
+                                                   self.marker_length,
+                                                   self.dictionary)
+
+        self._detector_params = self._make_detector_params(1)
+        if HAS_ARUCO_DETECTOR:
+            self._aruco_detector = aruco.ArucoDetector(
+                self.dictionary, self._detector_params)
+            self._charuco_detector = aruco.CharucoDetector(self.board)
+        else:
+            self._aruco_detector = None
+            self._charuco_detector = None
+
+        self._build_small_detector()
+
+    def _build_small_detector(self):
+        self._small_scale = self.DETECT_SCALE
+        self._detector_params_small = \
+            self._make_detector_params(self._small_scale)
+        if HAS_ARUCO_DETECTOR:
+            self._aruco_detector_small = aruco.ArucoDetector(
+                self.dictionary, self._detector_params_small)
+        else:
+            self._aruco_detector_small = None
+
+    def _make_detector_params(self, scale):
+        if HAS_ARUCO_DETECTOR:
+            params = aruco.DetectorParameters()
+        else:
+            params = aruco.DetectorParameters_create()
+
+        # threshold windows are in pixels, so shrink them along with the frame
+        params.cornerRefinementMethod = aruco.CORNER_REFINE_CONTOUR
+        params.adaptiveThreshWinSizeMin = max(3, int(100 * scale))
+        params.adaptiveThreshWinSizeMax = max(3, int(700 * scale))
+        params.adaptiveThreshWinSizeStep = max(1, int(50 * scale))
+        params.adaptiveThreshConstant = 0
+        return params
+
     def get_size(self):
         size = (self.squaresX, self.squaresY)
         return size
@@ -533,32 +994,63 @@ class CharucoBoard(CalibrationObject):
         return np.copy(self.empty_detection)
 
     def draw(self, size):
+        if HAS_ARUCO_DETECTOR:
+            return self.board.generateImage(size)
         return self.board.draw(size)
 
     def fill_points(self, corners, ids):
-        out = self.get_empty_detection()
         if corners is None or len(corners) == 0:
-            return out
-        ids = ids.ravel()
-        for i, cxs in zip(ids, corners):
-            out[i] = cxs
-        return out
+            return self.empty_detection
+        return _scatter_points(self.get_empty_detection(), corners, ids)
+
+    def _find_markers(self, gray, small=False):
+        if small:
+            if self._small_scale != self.DETECT_SCALE:
+                # DETECT_SCALE was changed after the detectors were made
+                self._build_small_detector()
+            params = self._detector_params_small
+            detector = self._aruco_detector_small
+        else:
+            params = self._detector_params
+            detector = self._aruco_detector
 
-    def detect_markers(self, image, camera=None, refine=True):
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if detector is None:
+            return aruco.detectMarkers(gray, self.dictionary,
+                                       parameters=params)
         else:
-            gray = image
+            return detector.detectMarkers(gray)
 
-        params = aruco.DetectorParameters_create()
-        params.cornerRefinementMethod = aruco.CORNER_REFINE_CONTOUR
-        params.adaptiveThreshWinSizeMin = 100
-        params.adaptiveThreshWinSizeMax = 700
-        params.adaptiveThreshWinSizeStep = 50
-        params.adaptiveThreshConstant = 0
+    def _min_cell_size(self, corners):
+        """Returns the side of the smallest bit cell, in pixels, over the given marker corners."""
+        quads = np.reshape(corners, (-1, 4, 2))
+        sides = np.linalg.norm(quads - np.roll(quads, 1, axis=1), axis=2)
+        return np.min(sides) / (self.marker_bits + 2)
 
-        corners, ids, rejectedImgPoints = aruco.detectMarkers(
-            gray, self.dictionary, parameters=params)
+    def detect_markers(self, image, camera=None, refine=True):
+        gray = self._to_gray(image)
+
+        params = self._detector_params
+        scale = self.DETECT_SCALE
+
+        if scale < 1:
+            if self._use_ocl(gray):
+                small = cv2.resize(cv2.UMat(gray), None, fx=scale, fy=scale,
+                                   interpolation=cv2.INTER_AREA).get()
+            else:
+                small = cv2.resize(gray, None, fx=scale, fy=scale,
+                                   interpolation=cv2.INTER_AREA)
+            corners, ids, rejectedImgPoints = self._find_markers(small, True)
+            if ids is None or len(ids) == 0 or \
+               self._min_cell_size(corners) < self.DETECT_SCALE_MIN_CELL_PX:
+                corners, ids, rejectedImgPoints = self._find_markers(gray)
+            else:
+                # map pixel centers back to full resolution coordinates
+                corners = [np.float32((c + 0.5) / scale - 0.5)
+                           for c in corners]
+                rejectedImgPoints = [np.float32((c + 0.5) / scale - 0.5)
+                                     for c in rejectedImgPoints]
+        else:
+            corners, ids, rejectedImgPoints = self._find_markers(gray)
 
         if ids is None:
             return [], []
@@ -569,7 +1061,11 @@ class CharucoBoard(CalibrationObject):
             K = camera.get_camera_matrix()
             D = camera.get_distortions()
 
-        if refine:
+        if refine and self._aruco_detector is not None:
+            detectedCorners, detectedIds, rejectedCorners, recoveredIdxs = \
+                self._aruco_detector.refineDetectedMarkers(
+                    gray, self.board, corners, ids, rejectedImgPoints, K, D)
+        elif refine:
             detectedCorners, detectedIds, rejectedCorners, recoveredIdxs = \
                 aruco.refineDetectedMarkers(gray, self.board, corners, ids,
                                             rejectedImgPoints,
@@ -581,15 +1077,19 @@ class CharucoBoard(CalibrationObject):
         return detectedCorners, detectedIds
 
     def detect_image(self, image, camera=None):
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image
-
-        corners, ids = self.detect_markers(image, camera, refine=True)
-        if len(corners) > 0:
-            ret, detectedCorners, detectedIds = aruco.interpolateCornersCharuco(
-                corners, ids, gray, self.board)
+        gray = self._to_gray(image)
+
+        corners, ids = self.detect_markers(gray, camera, refine=True)
+        if len(corners) >= max(1, self.MIN_MARKERS_FOR_INTERP):
+            if self._charuco_detector is None:
+                ret, detectedCorners, detectedIds = \
+                    aruco.interpolateCornersCharuco(corners, ids, gray,
+                                                    self.board)
+            else:
+                # hand over the markers found above so they are not detected again
+                detectedCorners, detectedIds, _, _ = \
+                    self._charuco_detector.detectBoard(
+                        gray, markerCorners=corners, markerIds=ids)
             if detectedIds is None:
                 detectedCorners = detectedIds = np.float64([])
         else:
@@ -604,13 +1104,12 @@ class CharucoBoard(CalibrationObject):
         if corners is None or ids is None or len(corners) < 4:
             return None, None
 
-        n_corners = corners.size // 2
-        corners = np.reshape(corners, (n_corners, 1, 2))
+        corners = _as_cv_points(corners)
 
         K = camera.get_camera_matrix()
         D = camera.get_distortions()
 
         ret, rvec, tvec = aruco.estimatePoseCharucoBoard(
-            corners, ids, self.board, K, D)
+            corners, ids, self.board, K, D, None, None)
 
         return rvec, tvec